@@ -23,6 +23,8 @@ WEBSITE_DIR = ROOT / "website"
 UPLOAD_DIR = ROOT / "uploads"
 UPLOAD_DIR.mkdir(parents=True, exist_ok=True)
 INDEX_PATH = ROOT / "file_index.json"
+INDEX_JOURNAL_PATH = ROOT / "file_index.journal"
+INDEX_LOCK_PATH = ROOT / "file_index.lock"
 UPLOAD_PAGE = WEBSITE_DIR / "upload.html"
 DOWNLOAD_PAGE = WEBSITE_DIR / "download.html"
 PREVIEW_TEMPLATE = WEBSITE_DIR / "preview.html"
@@ -40,6 +42,7 @@ HTTP_LISTING_PORT = int(os.getenv("HTTP_LISTING_PORT", "8004"))
 HTTP_LOGIN_PORT = int(os.getenv("HTTP_LOGIN_PORT", "8080"))
 ENABLE_UPLOAD_SERVER = _env_flag("ENABLE_UPLOAD_SERVER", True)
 ENABLE_LISTING_SERVER = _env_flag("ENABLE_LISTING_SERVER", True)
+HTTP_ACCESS_LOG = _env_flag("HTTP_ACCESS_LOG", False)
 MAX_UPLOAD_BYTES = int(os.getenv("MAX_UPLOAD_BYTES", str(5 * 1024 * 1024 * 1024)))
 EXTERNAL_URL = os.getenv("EXTERNAL_URL")
 PUBLIC_BASE_URL = os.getenv("PUBLIC_BASE_URL", "https://upload.dongurihub.jp")
@@ -48,6 +51,7 @@ LISTING_USERNAME = os.getenv("LISTING_USERNAME")
 LISTING_PASSWORD = os.getenv("LISTING_PASSWORD")
 LISTING_SESSION_SECRET = os.getenv("LISTING_SESSION_SECRET") or secrets.token_hex(32)
 LISTING_SESSION_TTL = int(os.getenv("LISTING_SESSION_TTL", str(12 * 60 * 60)))
+UPLOAD_CHUNK_BYTES = int(os.getenv("UPLOAD_CHUNK_BYTES", str(1024 * 1024)))
 MAX_IP_STORAGE_BYTES = int(
     os.getenv("MAX_IP_STORAGE_BYTES", str(80 * 1024 * 1024 * 1024))
 )
@@ -1,9 +1,8 @@
 from __future__ import annotations
 
-import mimetypes
+import asyncio
 import re
 
-import aiohttp
 import discord
 from aiohttp import web
 from discord import app_commands
@@ -12,23 +11,54 @@ from discord.ext import commands
 from config import (
     ENABLE_LISTING_SERVER,
     ENABLE_UPLOAD_SERVER,
+    HTTP_ACCESS_LOG,
     HTTP_HOST,
     HTTP_LISTING_PORT,
     HTTP_LOGIN_PORT,
     HTTP_PORT,
+    UPLOAD_CHUNK_BYTES,
 )
 from file_index import load_index
-from github_client import fetch_readme
-from helpers import format_timestamp, human_readable_size, public_base_url
-from web_server import create_listing_app, create_uploader_app
+from github_client import README_PREVIEW_CHARS, create_session, fetch_readme
+from helpers import (
+    format_timestamp,
+    guess_mime_type,
+    human_readable_size,
+    public_base_url,
+)
+from web_server import (
+    create_app,
+    refresh_allowed_users_async,
+    upsert_file_credential,
+)
 
-GITHUB_URL_PATTERN = re.compile(r"https://github.com/([\w\-]+)/([\w\-]+)(?:/|$)")
-FILE_URL_PATTERN = re.compile(r"(https?://[^\s/]+)/files/([0-9a-fA-F]+)")
+# GitHub repository links and shared-file links in one pattern, so ordinary
+# chat messages are scanned once.
+LINK_PATTERN = re.compile(
+    r"https://github\.com/(?P<owner>[\w-]+)/(?P<repo>[\w-]+)(?:/|$)"
+    r"|(?P<base>https?://[^\s/]+)/files/(?P<token>[0-9a-fA-F]+)"
+)
 
 UPLOAD_SERVER_DISABLED_LOGGED = False
 LISTING_SERVER_DISABLED_LOGGED = False
 
 
+def find_links(content: str) -> tuple[re.Match | None, re.Match | None]:
+    # First GitHub link and first shared-file link in the message.
+    github_match = file_match = None
+    if "http" not in content:
+        # Both kinds of link start with "http"; skip the regex for plain chat.
+        return github_match, file_match
+    for match in LINK_PATTERN.finditer(content):
+        if match.group("owner"):
+            github_match = github_match or match
+        else:
+            file_match = file_match or match
+        if github_match and file_match:
+            break
+    return github_match, file_match
+
+
 def configure_bot(bot: commands.Bot) -> None:
     register_events(bot)
     register_commands(bot)
@@ -41,45 +71,43 @@ def register_events(bot: commands.Bot) -> None:
         print(f"Logged in as {bot.user}")
 
         if not hasattr(bot, "session"):
-            bot.session = aiohttp.ClientSession()
-
-        if ENABLE_UPLOAD_SERVER:
-            if not hasattr(bot, "web_runner"):
-                upload_app = create_uploader_app()
-                runner = web.AppRunner(upload_app)
-                await runner.setup()
-                site = web.TCPSite(runner, HTTP_HOST, HTTP_PORT)
-                await site.start()
-                bot.web_runner = runner
-                print(f"HTTP server started on {HTTP_HOST}:{HTTP_PORT}")
-        elif not UPLOAD_SERVER_DISABLED_LOGGED:
+            bot.session = create_session()
+
+        if not ENABLE_UPLOAD_SERVER and not UPLOAD_SERVER_DISABLED_LOGGED:
             print("Skipping embedded upload server (ENABLE_UPLOAD_SERVER=0)")
             UPLOAD_SERVER_DISABLED_LOGGED = True
+        if not ENABLE_LISTING_SERVER and not LISTING_SERVER_DISABLED_LOGGED:
+            print("Skipping listing/login server (ENABLE_LISTING_SERVER=0)")
+            LISTING_SERVER_DISABLED_LOGGED = True
 
-        if ENABLE_LISTING_SERVER:
-            if not hasattr(bot, "listing_runner"):
-                listing_app = create_listing_app()
-                listing_runner = web.AppRunner(listing_app)
-                await listing_runner.setup()
-                listing_site = web.TCPSite(
-                    listing_runner, HTTP_HOST, HTTP_LISTING_PORT
-                )
-                await listing_site.start()
-                bot.listing_site = listing_site
+        if (ENABLE_UPLOAD_SERVER or ENABLE_LISTING_SERVER) and not hasattr(
+            bot, "web_runner"
+        ):
+            app = create_app(
+                uploader=ENABLE_UPLOAD_SERVER, listing=ENABLE_LISTING_SERVER
+            )
+            # Let the request stream buffer a whole upload chunk so
+            # read_chunk(UPLOAD_CHUNK_BYTES) is not capped at 64 KiB. Access
+            # logging is opt-in: discord.py sets the root logger to INFO,
+            # which would otherwise log every request through aiohttp.access.
+            runner = web.AppRunner(
+                app,
+                read_bufsize=UPLOAD_CHUNK_BYTES,
+                access_log=web.access_logger if HTTP_ACCESS_LOG else None,
+            )
+            await runner.setup()
+            if ENABLE_UPLOAD_SERVER:
+                await web.TCPSite(runner, HTTP_HOST, HTTP_PORT).start()
+                print(f"HTTP server started on {HTTP_HOST}:{HTTP_PORT}")
+            if ENABLE_LISTING_SERVER:
+                await web.TCPSite(runner, HTTP_HOST, HTTP_LISTING_PORT).start()
                 if HTTP_LOGIN_PORT != HTTP_LISTING_PORT:
-                    login_site = web.TCPSite(
-                        listing_runner, HTTP_HOST, HTTP_LOGIN_PORT
-                    )
-                    await login_site.start()
-                    bot.login_site = login_site
+                    await web.TCPSite(runner, HTTP_HOST, HTTP_LOGIN_PORT).start()
                     print(
                         f"Login page server started on {HTTP_HOST}:{HTTP_LOGIN_PORT}"
                     )
-                bot.listing_runner = listing_runner
                 print(f"Listing server started on {HTTP_HOST}:{HTTP_LISTING_PORT}")
-        elif not LISTING_SERVER_DISABLED_LOGGED:
-            print("Skipping listing/login server (ENABLE_LISTING_SERVER=0)")
-            LISTING_SERVER_DISABLED_LOGGED = True
+            bot.web_runner = runner
 
         try:
             synced = await bot.tree.sync()
@@ -93,21 +121,26 @@ def register_events(bot: commands.Bot) -> None:
             await bot.session.close()
         if hasattr(bot, "web_runner"):
             await bot.web_runner.cleanup()
-        if hasattr(bot, "listing_runner"):
-            await bot.listing_runner.cleanup()
 
     @bot.event
     async def on_message(message: discord.Message) -> None:  # type: ignore[misc]
         if message.author.bot:
             return
 
-        match = GITHUB_URL_PATTERN.search(message.content)
+        content = message.content
+        match, file_match = find_links(content)
+        if not (match or file_match):
+            await bot.process_commands(message)
+            return
+
         if match and hasattr(bot, "session"):
-            owner, repo = match.groups()
+            owner, repo = match.group("owner", "repo")
             await suppress_original(message)
             readme_text = await fetch_readme(bot.session, owner, repo)
             if readme_text:
-                preview = readme_text[:500] + ("..." if len(readme_text) > 500 else "")
+                preview = readme_text[:README_PREVIEW_CHARS]
+                if len(readme_text) > README_PREVIEW_CHARS:
+                    preview += "..."
                 embed = discord.Embed(
                     title=f"{owner}/{repo} README",
                     description=f"```\n{preview}\n```",
@@ -117,22 +150,25 @@ def register_events(bot: commands.Bot) -> None:
             else:
                 await message.channel.send(f"README not found for **{owner}/{repo}**")
 
-        file_match = FILE_URL_PATTERN.search(message.content)
         if file_match:
-            base, token = file_match.groups()
+            base, token = file_match.group("base", "token")
             index = load_index()
             meta = index.get(token)
             if meta:
                 filename = meta.get("filename", "file")
-                size_readable = human_readable_size(meta.get("size", 0))
-                uploaded_at = format_timestamp(meta.get("timestamp"))
+                size_readable = meta.get("size_readable") or human_readable_size(
+                    meta.get("size", 0)
+                )
+                uploaded_at = meta.get("uploaded_at") or format_timestamp(
+                    meta.get("timestamp")
+                )
                 page_url = f"{base}/files/{token}"
                 embed = discord.Embed(
                     title=f"共有ファイル: {filename}",
                     description=f"[こちらからダウンロード]({page_url})",
                     color=0x4E73DF,
                 )
-                mime_type, _ = mimetypes.guess_type(filename)
+                mime_type = meta.get("mime_type") or guess_mime_type(filename)
                 file_type = mime_type or "不明"
                 embed.add_field(name="ファイルサイズ", value=size_readable, inline=True)
                 embed.add_field(name="アップロード", value=uploaded_at, inline=True)
@@ -149,15 +185,31 @@ def register_events(bot: commands.Bot) -> None:
 
 
 def register_commands(bot: commands.Bot) -> None:
-    class VerifyButton(discord.ui.Button):
+    # The role is carried in the custom_id, so one registration answers every
+    # verify message ever posted, including those sent before a restart.
+    class VerifyButton(
+        discord.ui.DynamicItem[discord.ui.Button],
+        template=r"verify_button_(?P<role_id>[0-9]+)",
+    ):
         def __init__(self, role_id: int) -> None:
             super().__init__(
-                label="認証する",
-                style=discord.ButtonStyle.success,
-                custom_id=f"verify_button_{role_id}",
+                discord.ui.Button(
+                    label="認証する",
+                    style=discord.ButtonStyle.success,
+                    custom_id=f"verify_button_{role_id}",
+                )
             )
             self.role_id = role_id
 
+        @classmethod
+        async def from_custom_id(  # type: ignore[override]
+            cls,
+            interaction: discord.Interaction,
+            item: discord.ui.Button,
+            match: re.Match[str],
+        ) -> "VerifyButton":
+            return cls(int(match["role_id"]))
+
         async def callback(self, interaction: discord.Interaction) -> None:  # type: ignore[override]
             role = interaction.guild.get_role(self.role_id)
             if not role:
@@ -168,6 +220,8 @@ def register_commands(bot: commands.Bot) -> None:
             await interaction.user.add_roles(role)
             await interaction.response.send_message("認証されました！", ephemeral=True)
 
+    bot.add_dynamic_items(VerifyButton)
+
     @app_commands.checks.has_permissions(administrator=True)
     @bot.tree.command(name="setupverify", description="認証用メッセージを送信します")
     @app_commands.describe(role="認証時に付与するロール")
@@ -191,7 +245,7 @@ def register_commands(bot: commands.Bot) -> None:
             description="以下のボタンを押して認証してください。",
             color=0x00FF00,
         )
-        view = discord.ui.View()
+        view = discord.ui.View(timeout=None)
         view.add_item(VerifyButton(role.id))
         await interaction.response.send_message(embed=embed, view=view)
 
@@ -199,12 +253,45 @@ def register_commands(bot: commands.Bot) -> None:
         name="upload", description="アップロードページのリンクを表示します"
     )
     async def upload_link(interaction: discord.Interaction) -> None:
-        base = public_base_url()
-        url = f"{base}/" if not base.endswith("/") else base
+        # public_base_url() is stripped of trailing slashes at import.
+        url = public_base_url() + "/"
         await interaction.response.send_message(
             f"📤 ファイルアップロードはこちらからどうぞ:\n{url}", ephemeral=False
         )
 
+    @app_commands.checks.has_permissions(administrator=True)
+    @bot.tree.command(
+        name="adduser", description="共有一覧のログインユーザーを追加/更新します"
+    )
+    @app_commands.describe(
+        username="追加または上書きするユーザーID", password="設定するパスワード"
+    )
+    async def adduser(
+        interaction: discord.Interaction, username: str, password: str
+    ) -> None:
+        username = (username or "").strip()
+        password = password or ""
+        if not username or not password:
+            await interaction.response.send_message(
+                "ユーザーIDとパスワードを入力してください。", ephemeral=True
+            )
+            return
+
+        try:
+            existed = await asyncio.to_thread(
+                upsert_file_credential, username, password
+            )
+            # Forced past the throttle so the new password works right away.
+            await refresh_allowed_users_async(force=True)
+            action = "更新" if existed else "追加"
+            await interaction.response.send_message(
+                f"✅ ログインユーザーを{action}しました: `{username}`", ephemeral=True
+            )
+        except Exception as exc:
+            await interaction.response.send_message(
+                f"ユーザー追加に失敗しました: {exc}", ephemeral=True
+            )
+
 
 async def suppress_original(message: discord.Message) -> None:
     try:
@@ -1,27 +1,413 @@
 from __future__ import annotations
 
-import json
-from typing import Dict
+import asyncio
+import atexit
+import bisect
+import contextlib
+import functools
+import hashlib
+import os
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
 
-from config import INDEX_PATH, TOKEN_PATH
+import orjson
+
+from config import INDEX_JOURNAL_PATH, INDEX_LOCK_PATH, INDEX_PATH, TOKEN_PATH
+
+try:
+    import fcntl
+except ImportError:  # Windows: writes are only serialized within a process
+    fcntl = None  # type: ignore[assignment]
 
 IndexRecord = Dict[str, Dict]
+# (snapshot mtime_ns, snapshot size, journal size) as last seen on disk.
+DiskStamp = Tuple[int, int, int]
+
+# Parsed index shared by every handler; re-read only when the snapshot or the
+# journal changes on disk so that hot GETs become plain dict lookups. "by_ip"
+# maps each client IP to its tokens (in index order) and "usage" to the bytes
+# it has stored; both are rebuilt whenever "data" is replaced and kept in step
+# by add_entry/remove_entry. "recent" holds the tokens newest-first; it is
+# sorted lazily after a reload and patched by single adds/removes, each of
+# which swaps in a new list. "pending" counts in-memory changes that have not
+# been written to disk yet, "journaled" is set while this process has journal
+# lines that no snapshot of its own has folded in, and "compact" asks the next
+# write for a full snapshot.
+_INDEX_CACHE: Dict[str, object] = {
+    "stamp": None,
+    "data": {},
+    "by_ip": {},
+    "usage": {},
+    "recent": None,
+    "pending": 0,
+    "journaled": False,
+    "compact": False,
+}
+
+# Uploads and deletes are appended to a journal (one JSON line per change)
+# instead of rewriting file_index.json. The journal is folded back into the
+# snapshot once it grows past a quarter of the snapshot, and on shutdown.
+# The first line names the snapshot the journal was started against, so a
+# journal left behind by an interrupted compaction is not replayed onto the
+# snapshot that already contains it.
+COMPACT_MIN_BYTES = 64 * 1024
+_JOURNAL: List[bytes] = []
+# Digest of file_index.json keyed by its (mtime_ns, size), so appends do not
+# re-hash an unchanged snapshot.
+_SNAPSHOT_ID: Dict[str, object] = {"key": None, "digest": ""}
+
+# Saves made from the event loop are coalesced and written this many seconds
+# later, so a burst of uploads/deletes costs one write. Once FLUSH_BATCH
+# changes are waiting the write starts without finishing the delay.
+FLUSH_DELAY = 0.25
+FLUSH_BATCH = 32
+_FLUSH_TASK: Optional[asyncio.Task] = None
+_FLUSH_WAKE: Optional[asyncio.Event] = None
 
 
 def load_token() -> str:
     return TOKEN_PATH.read_text(encoding="utf-8").strip()
 
 
-def load_index() -> IndexRecord:
-    if not INDEX_PATH.exists():
-        return {}
+def _set_data(index: IndexRecord) -> None:
+    # Dicts are used as insertion-ordered sets so removal stays O(1).
+    by_ip: Dict[str, Dict[str, None]] = {}
+    usage: Dict[str, int] = {}
+    for token, meta in index.items():
+        ip = meta.get("ip")
+        by_ip.setdefault(ip, {})[token] = None
+        usage[ip] = usage.get(ip, 0) + (meta.get("size") or 0)
+    _INDEX_CACHE["data"] = index
+    _INDEX_CACHE["by_ip"] = by_ip
+    _INDEX_CACHE["usage"] = usage
+    _INDEX_CACHE["recent"] = None
+
+
+def _forget(token: str, meta: Dict) -> None:
+    # Drops an entry that has left "data" from the per-IP tables.
+    ip = meta.get("ip")
+    tokens = _INDEX_CACHE["by_ip"].get(ip)
+    if tokens is not None:
+        tokens.pop(token, None)
+        if not tokens:
+            del _INDEX_CACHE["by_ip"][ip]
+    usage = _INDEX_CACHE["usage"]
+    remaining = usage.get(ip, 0) - (meta.get("size") or 0)
+    if remaining > 0 and ip in _INDEX_CACHE["by_ip"]:
+        usage[ip] = remaining
+    else:
+        usage.pop(ip, None)
+
+
+def _disk_stamp() -> Optional[DiskStamp]:
     try:
-        return json.loads(INDEX_PATH.read_text(encoding="utf-8"))
+        snapshot = INDEX_PATH.stat()
+    except FileNotFoundError:
+        snapshot = None
+    try:
+        journal_size = INDEX_JOURNAL_PATH.stat().st_size
+    except FileNotFoundError:
+        journal_size = 0
+    if snapshot is None:
+        return (0, 0, journal_size) if journal_size else None
+    return snapshot.st_mtime_ns, snapshot.st_size, journal_size
+
+
+def _snapshot_digest(snapshot: bytes) -> str:
+    return hashlib.blake2b(snapshot, digest_size=16).hexdigest()
+
+
+def _journal_header(digest: str) -> bytes:
+    return orjson.dumps({"op": "base", "snapshot": digest}) + b"\n"
+
+
+def _current_snapshot_digest() -> str:
+    try:
+        stat = INDEX_PATH.stat()
+    except FileNotFoundError:
+        return _snapshot_digest(b"")
+    key = (stat.st_mtime_ns, stat.st_size)
+    if key != _SNAPSHOT_ID["key"]:
+        _SNAPSHOT_ID["digest"] = _snapshot_digest(INDEX_PATH.read_bytes())
+        _SNAPSHOT_ID["key"] = key
+    return _SNAPSHOT_ID["digest"]  # type: ignore[return-value]
+
+
+def _journal_base(line: bytes) -> Optional[str]:
+    # Snapshot digest named by a journal's first line, or None for a journal
+    # written before the header existed (always replayed).
+    try:
+        record = orjson.loads(line)
+    except orjson.JSONDecodeError:
+        return None
+    if record.get("op") != "base":
+        return None
+    return record.get("snapshot")
+
+
+def _replay(data: IndexRecord, journal: bytes) -> None:
+    for line in journal.splitlines():
+        try:
+            record = orjson.loads(line)
+        except orjson.JSONDecodeError:
+            # A torn final line from a crash mid-append; earlier lines stand.
+            continue
+        if record.get("op") == "put":
+            data[record["token"]] = record["meta"]
+        elif record.get("op") == "del":
+            data.pop(record["token"], None)
+
+
+def _read_disk() -> Tuple[IndexRecord, bool]:
+    # Returns the index and whether the journal ends in a torn line.
+    try:
+        snapshot = INDEX_PATH.read_bytes()
+    except FileNotFoundError:
+        snapshot = b""
+    try:
+        data = orjson.loads(snapshot)
     except Exception:
+        data = {}
+    try:
+        journal = INDEX_JOURNAL_PATH.read_bytes()
+    except FileNotFoundError:
+        journal = b""
+    base = _journal_base(journal.split(b"\n", 1)[0]) if journal else None
+    if base is not None and base != _snapshot_digest(snapshot):
+        # Left over from a compaction that stopped between the rename and the
+        # unlink; the snapshot already holds every line of it.
+        return data, False
+    _replay(data, journal)
+    return data, bool(journal) and not journal.endswith(b"\n")
+
+
+def load_index() -> IndexRecord:
+    # Pending or in-flight writes mean memory is newer than the files.
+    if _INDEX_CACHE["pending"] or _FLUSH_TASK is not None:
+        return _INDEX_CACHE["data"]  # type: ignore[return-value]
+    stamp = _disk_stamp()
+    if stamp is None:
         return {}
+    if stamp != _INDEX_CACHE["stamp"]:
+        data, torn = _read_disk()
+        if torn:
+            # Appending after a torn line would glue the next record onto it,
+            # so the next write replaces snapshot and journal instead.
+            _INDEX_CACHE["compact"] = True
+        _INDEX_CACHE["stamp"] = stamp
+        _set_data(data)
+    return _INDEX_CACHE["data"]  # type: ignore[return-value]
+
+
+def _write_snapshot(payload: bytes) -> Optional[DiskStamp]:
+    # Write to a sibling file and rename it into place so readers never
+    # observe a half-written index. The data is synced before the rename so the
+    # swap never exposes an empty file. If we stop before the unlink, the old
+    # journal's header no longer matches the snapshot and it is skipped on
+    # load (deleted entries stay deleted) and overwritten by the next append.
+    tmp_path = INDEX_PATH.with_suffix(".json.tmp")
+    with tmp_path.open("wb") as f:
+        f.write(payload)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, INDEX_PATH)
+    INDEX_JOURNAL_PATH.unlink(missing_ok=True)
+    stamp = _disk_stamp()
+    if stamp is not None:
+        _SNAPSHOT_ID["key"] = stamp[:2]
+        _SNAPSHOT_ID["digest"] = _snapshot_digest(payload)
+    return stamp
+
+
+def _append_journal(lines: bytes) -> Optional[DiskStamp]:
+    digest = _current_snapshot_digest()
+    try:
+        with INDEX_JOURNAL_PATH.open("rb") as f:
+            first = f.readline()
+    except FileNotFoundError:
+        first = b""
+    mode = "ab"
+    if not first or _journal_base(first) not in (None, digest):
+        # No journal yet, or a stale one whose lines the snapshot already has.
+        mode = "wb"
+        lines = _journal_header(digest) + lines
+    with INDEX_JOURNAL_PATH.open(mode) as f:
+        f.write(lines)
+        f.flush()
+        os.fsync(f.fileno())
+    return _disk_stamp()
+
+
+@contextlib.contextmanager
+def _disk_lock():
+    # The bot and the web server may run as separate processes sharing these
+    # files, so each write and the stamp check before it hold this lock.
+    if fcntl is None:
+        yield
+        return
+    with INDEX_LOCK_PATH.open("ab") as f:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        yield
+
+
+def _write(
+    lines: bytes, snapshot: Optional[bytes], expected: Optional[DiskStamp]
+) -> Optional[DiskStamp]:
+    # Appends lines, or replaces the files with snapshot when one is given.
+    with _disk_lock():
+        if _disk_stamp() == expected:
+            if snapshot is None:
+                return _append_journal(lines)
+            return _write_snapshot(snapshot)
+        # Another process wrote since this one last loaded, so our copy is
+        # stale: build on what is on disk instead, and return no stamp so the
+        # next idle load_index() re-reads the files.
+        if snapshot is None:
+            _append_journal(lines)
+        else:
+            data, _ = _read_disk()
+            _replay(data, lines)
+            _write_snapshot(orjson.dumps(data))
+        return None
+
+
+def _next_write() -> Callable[[], Optional[DiskStamp]]:
+    # Runs on the loop so the dict cannot change mid-dump; the returned
+    # writer does the file I/O and may run in a worker thread.
+    _INDEX_CACHE["pending"] = 0
+    lines = b"".join(_JOURNAL)
+    _JOURNAL.clear()
+    stamp = _INDEX_CACHE["stamp"]
+    _, snapshot_size, journal_size = stamp or (0, 0, 0)
+    limit = max(snapshot_size // 4, COMPACT_MIN_BYTES)
+    snapshot = None
+    if _INDEX_CACHE["compact"] or journal_size + len(lines) > limit:
+        _INDEX_CACHE["compact"] = False
+        snapshot = orjson.dumps(_INDEX_CACHE["data"])
+    _INDEX_CACHE["journaled"] = snapshot is None
+    return functools.partial(_write, lines, snapshot, stamp)
+
+
+def _request_compaction() -> bool:
+    # Schedules a full snapshot if this process has changes pending or only
+    # journaled. A process that wrote nothing leaves the files alone: another
+    # process may own newer changes that its copy has never seen.
+    if not (_INDEX_CACHE["pending"] or _INDEX_CACHE["journaled"]):
+        return False
+    _INDEX_CACHE["compact"] = True
+    _INDEX_CACHE["pending"] = max(_INDEX_CACHE["pending"], 1)
+    return True
+
+
+def _flush_now(compact: bool = False) -> None:
+    if compact:
+        _request_compaction()
+    if _INDEX_CACHE["pending"]:
+        _INDEX_CACHE["stamp"] = _next_write()()
+
+
+async def _flush_later() -> None:
+    global _FLUSH_TASK
+    try:
+        with contextlib.suppress(asyncio.TimeoutError):
+            await asyncio.wait_for(_FLUSH_WAKE.wait(), FLUSH_DELAY)
+        while _INDEX_CACHE["pending"]:
+            _INDEX_CACHE["stamp"] = await asyncio.to_thread(_next_write())
+    finally:
+        _FLUSH_TASK = None
+
+
+def _mark_dirty() -> None:
+    global _FLUSH_TASK, _FLUSH_WAKE
+    _INDEX_CACHE["pending"] += 1
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        _flush_now()
+        return
+    if _FLUSH_TASK is None:
+        _FLUSH_WAKE = asyncio.Event()
+        _FLUSH_TASK = loop.create_task(_flush_later())
+    elif _INDEX_CACHE["pending"] >= FLUSH_BATCH:
+        _FLUSH_WAKE.set()
+
+
+def add_entry(token: str, meta: Dict) -> None:
+    # Single uploads/deletes keep the per-IP tables in step and only journal
+    # the one change.
+    index = load_index()
+    if index is not _INDEX_CACHE["data"]:
+        _set_data(index)
+    previous = index.get(token)
+    if previous is not None:
+        _forget(token, previous)
+        _INDEX_CACHE["recent"] = None
+    index[token] = meta
+    recent = _INDEX_CACHE["recent"]
+    if recent is not None:
+        # Slot the new token in after every entry at least as new, where the
+        # stable sort in tokens_by_time() would put it. The list is copied
+        # rather than changed in place because callers may hold the old one.
+        stamp = -(meta.get("timestamp") or 0)
+        recent = recent.copy()
+        recent.insert(
+            bisect.bisect_right(
+                recent, stamp, key=lambda t: -(index[t].get("timestamp") or 0)
+            ),
+            token,
+        )
+        _INDEX_CACHE["recent"] = recent
+    ip = meta.get("ip")
+    _INDEX_CACHE["by_ip"].setdefault(ip, {})[token] = None
+    usage = _INDEX_CACHE["usage"]
+    usage[ip] = usage.get(ip, 0) + (meta.get("size") or 0)
+    _JOURNAL.append(orjson.dumps({"op": "put", "token": token, "meta": meta}) + b"\n")
+    _mark_dirty()
+
+
+def remove_entry(token: str) -> None:
+    index = load_index()
+    meta = index.pop(token, None)
+    if meta is None:
+        return
+    _forget(token, meta)
+    recent = _INDEX_CACHE["recent"]
+    if recent is not None:
+        _INDEX_CACHE["recent"] = [t for t in recent if t != token]
+    _JOURNAL.append(orjson.dumps({"op": "del", "token": token}) + b"\n")
+    _mark_dirty()
+
+
+async def flush_index() -> None:
+    # Called on shutdown: write what is pending and fold the journal into the
+    # snapshot. The atexit hook covers exits that skip cleanup.
+    if _FLUSH_TASK is not None:
+        await _FLUSH_TASK
+    if _request_compaction():
+        _INDEX_CACHE["stamp"] = await asyncio.to_thread(_next_write())
+
+
+atexit.register(_flush_now, True)
+
+
+def tokens_for_ip(ip: str) -> Iterable[str]:
+    load_index()
+    return _INDEX_CACHE["by_ip"].get(ip, ())  # type: ignore[union-attr]
+
+
+def usage_for_ip(ip: str) -> int:
+    # Total size of the files uploaded from ip, for the per-IP quota.
+    load_index()
+    return _INDEX_CACHE["usage"].get(ip, 0)  # type: ignore[union-attr]
 
 
-def save_index(index: IndexRecord) -> None:
-    INDEX_PATH.write_text(
-        json.dumps(index, ensure_ascii=False, indent=2), encoding="utf-8"
-    )
+def tokens_by_time() -> List[str]:
+    index = load_index()
+    recent = _INDEX_CACHE["recent"]
+    if recent is None or index is not _INDEX_CACHE["data"]:
+        # Stable sort, so equal timestamps keep index order as before.
+        recent = sorted(
+            index, key=lambda token: index[token].get("timestamp") or 0, reverse=True
+        )
+        if index is _INDEX_CACHE["data"]:
+            _INDEX_CACHE["recent"] = recent
+    return recent  # type: ignore[return-value]
@@ -1,21 +1,85 @@
 from __future__ import annotations
 
-from typing import Optional
+import time
+from collections import OrderedDict
+from typing import Optional, Tuple
 
 import aiohttp
+from aiohttp.abc import AbstractResolver
+from aiohttp.resolver import AsyncResolver
 
 GITHUB_API_URL = "https://api.github.com/repos"
 GITHUB_HEADERS = {"Accept": "application/vnd.github.v3.raw"}
 
+README_CACHE_TTL = 600
+README_CACHE_SIZE = 256
+# Only the start of a README is ever shown; one extra character is kept so
+# callers can tell that the text was cut.
+README_PREVIEW_CHARS = 500
+# (owner, repo) -> (fetched_at, text, etag); misses are cached too so a link to
+# a repository without a README does not hit the API on every message.
+_README_CACHE: OrderedDict[
+    Tuple[str, str], Tuple[float, Optional[str], Optional[str]]
+] = OrderedDict()
+
+
+def _make_resolver() -> Optional[AbstractResolver]:
+    # AsyncResolver needs the optional aiodns package; without it aiohttp's
+    # default resolver runs getaddrinfo in a thread.
+    try:
+        return AsyncResolver()
+    except RuntimeError:
+        return None
+
+
+def create_session() -> aiohttp.ClientSession:
+    connector = aiohttp.TCPConnector(
+        resolver=_make_resolver(),
+        limit=50,
+        limit_per_host=10,
+        ttl_dns_cache=600,
+        keepalive_timeout=75,
+    )
+    # A larger read buffer lets big READMEs arrive in fewer reads.
+    return aiohttp.ClientSession(
+        connector=connector,
+        headers=GITHUB_HEADERS,
+        timeout=aiohttp.ClientTimeout(total=10, connect=3),
+        read_bufsize=4 * 1024 * 1024,
+    )
+
 
 async def fetch_readme(
     session: aiohttp.ClientSession, owner: str, repo: str
 ) -> Optional[str]:
+    # Returns at most README_PREVIEW_CHARS + 1 characters of the README.
+    key = (owner, repo)
+    entry = _README_CACHE.get(key)
+    if entry and time.monotonic() - entry[0] < README_CACHE_TTL:
+        _README_CACHE.move_to_end(key)
+        return entry[1]
+
     url = f"{GITHUB_API_URL}/{owner}/{repo}/readme"
+    # Revalidate stale entries; a 304 costs no body and no rate-limit quota.
+    headers = {"If-None-Match": entry[2]} if entry and entry[2] else None
+    text = etag = None
     try:
-        async with session.get(url, headers=GITHUB_HEADERS) as resp:
-            if resp.status == 200:
-                return await resp.text()
+        async with session.get(url, headers=headers) as resp:
+            if resp.status == 304 and entry:
+                text, etag = entry[1], entry[2]
+            elif resp.status == 200:
+                text = (await resp.text())[: README_PREVIEW_CHARS + 1]
+                etag = resp.headers.get("ETag")
+            elif resp.status != 404:
+                # Rate limits (403/429) and server errors are transient, so
+                # only a definite "no README" is remembered as None.
+                return None
     except Exception as exc:
         print(f"Error fetching README: {exc}")
-    return None
+        return None
+
+    _README_CACHE[key] = (time.monotonic(), text, etag)
+    _README_CACHE.move_to_end(key)
+    if len(_README_CACHE) > README_CACHE_SIZE:
+        _README_CACHE.popitem(last=False)
+    return text
@@ -1,47 +1,85 @@
 from __future__ import annotations
 
 import html
+import mimetypes
+import os
 import pathlib
+import re
 from datetime import datetime
-from typing import Dict, Optional
+from functools import lru_cache
+from typing import Dict, List, Optional, Tuple
 
 from aiohttp import web
 
 from config import EXTERNAL_URL, HTTP_HOST, HTTP_PORT, PUBLIC_BASE_URL
 
-IMAGE_EXTENSIONS = {".png", ".jpg", ".jpeg", ".gif", ".bmp", ".webp"}
-VIDEO_EXTENSIONS = {".mp4", ".webm", ".mov", ".mkv", ".avi"}
-AUDIO_EXTENSIONS = {".mp3", ".wav", ".ogg", ".m4a", ".aac", ".flac"}
-TEXT_EXTENSIONS = {
-    ".txt",
-    ".md",
-    ".log",
-    ".json",
-    ".csv",
-    ".py",
-    ".js",
-    ".ts",
-    ".html",
-    ".css",
-    ".yaml",
-    ".yml",
-    ".ini",
-    ".cfg",
+IMAGE_EXTENSIONS = frozenset({".png", ".jpg", ".jpeg", ".gif", ".bmp", ".webp"})
+VIDEO_EXTENSIONS = frozenset({".mp4", ".webm", ".mov", ".mkv", ".avi"})
+AUDIO_EXTENSIONS = frozenset({".mp3", ".wav", ".ogg", ".m4a", ".aac", ".flac"})
+TEXT_EXTENSIONS = frozenset(
+    {
+        ".txt",
+        ".md",
+        ".log",
+        ".json",
+        ".csv",
+        ".py",
+        ".js",
+        ".ts",
+        ".html",
+        ".css",
+        ".yaml",
+        ".yml",
+        ".ini",
+        ".cfg",
+    }
+)
+
+# Preview kind lookup tables: exact MIME types first, then the MIME major type,
+# then the file extension.
+_MIME_KINDS = {"application/pdf": "pdf", "application/json": "text"}
+_MIME_MAJOR_KINDS = {
+    "image": "image",
+    "video": "video",
+    "audio": "audio",
+    "text": "text",
 }
+_EXTENSION_KINDS = {
+    **dict.fromkeys(TEXT_EXTENSIONS, "text"),
+    ".pdf": "pdf",
+    **dict.fromkeys(AUDIO_EXTENSIONS, "audio"),
+    **dict.fromkeys(VIDEO_EXTENSIONS, "video"),
+    **dict.fromkeys(IMAGE_EXTENSIONS, "image"),
+}
+
+PREVIEW_CHARS = 4000
+
+_SIZE_UNITS = ("B", "KB", "MB", "GB", "TB", "PB")
+
+# The configured base URLs are fixed for the life of the process.
+_EXTERNAL_BASE = EXTERNAL_URL.rstrip("/") if EXTERNAL_URL else ""
+_PUBLIC_BASE = (
+    _EXTERNAL_BASE
+    or (PUBLIC_BASE_URL or "").rstrip("/")
+    or f"http://{HTTP_HOST}:{HTTP_PORT}"
+)
+
+PLACEHOLDER_PATTERN = re.compile(r"\{\{(\w+)\}\}")
+_TEMPLATE_CACHE: Dict[pathlib.Path, Tuple[int, List[str]]] = {}
 
 
 def human_readable_size(size: int) -> str:
-    size = float(size or 0)
-    units = ["B", "KB", "MB", "GB", "TB"]
-    for unit in units:
-        if size < 1024 or unit == units[-1]:
-            if unit == "B":
-                return f"{int(size)} B"
-            return f"{size:.2f} {unit}"
-        size /= 1024
-    return f"{size:.2f} TB"
+    if not size:
+        return "0 B"
+    if size < 1024:
+        return f"{int(size)} B"
+    # Each unit is 2**10 of the previous one, so the bit length picks it.
+    idx = min((int(size).bit_length() - 1) // 10, len(_SIZE_UNITS) - 1)
+    return f"{size / (1 << (idx * 10)):.2f} {_SIZE_UNITS[idx]}"
 
 
+# Listings re-format the same upload times on every request.
+@lru_cache(maxsize=4096)
 def format_timestamp(ts: Optional[int]) -> str:
     if not ts:
         return "-"
@@ -51,62 +89,94 @@ def format_timestamp(ts: Optional[int]) -> str:
         return "-"
 
 
+def _load_template(path: pathlib.Path) -> List[str]:
+    # Templates are kept pre-split as [text, KEY, text, KEY, ..., text] so a
+    # render only fills the odd slots and joins.
+    mtime = path.stat().st_mtime_ns
+    cached = _TEMPLATE_CACHE.get(path)
+    if cached and cached[0] == mtime:
+        return cached[1]
+    segments = PLACEHOLDER_PATTERN.split(path.read_text(encoding="utf-8"))
+    _TEMPLATE_CACHE[path] = (mtime, segments)
+    return segments
+
+
+@lru_cache(maxsize=512)
+def _guess_mime_for_suffix(suffix: str) -> Optional[str]:
+    return mimetypes.guess_type(f"file{suffix}")[0]
+
+
+def guess_mime_type(filename: str) -> Optional[str]:
+    # The last two suffixes are all mimetypes looks at (".tar.gz" and friends),
+    # so they make a small cache key without changing the result. Case is
+    # kept: encodings such as ".Z" are case-sensitive, and mimetypes already
+    # retries types in lower case.
+    suffixes = pathlib.PurePath(filename).suffixes[-2:]
+    return _guess_mime_for_suffix("".join(suffixes))
+
+
 def render_template(path: pathlib.Path, replacements: Dict[str, str]) -> str:
-    template = path.read_text(encoding="utf-8")
-    for key, value in replacements.items():
-        template = template.replace(f"{{{{{key}}}}}", value)
-    return template
+    parts = list(_load_template(path))
+    for i in range(1, len(parts), 2):
+        key = parts[i]
+        parts[i] = replacements.get(key, f"{{{{{key}}}}}")
+    return "".join(parts)
 
 
 def build_preview_payload(
-    path: pathlib.Path, filename: str, mime_type: Optional[str]
+    path: pathlib.Path,
+    filename: str,
+    mime_type: Optional[str],
+    size: Optional[int] = None,
 ) -> Dict[str, object]:
-    file_ext = pathlib.Path(filename).suffix.lower()
-    if (mime_type and mime_type.startswith("image/")) or (file_ext in IMAGE_EXTENSIONS):
-        return {"kind": "image"}
-    if (mime_type and mime_type.startswith("video/")) or (file_ext in VIDEO_EXTENSIONS):
-        return {"kind": "video"}
-    if (mime_type and mime_type.startswith("audio/")) or (file_ext in AUDIO_EXTENSIONS):
-        return {"kind": "audio"}
-    if mime_type == "application/pdf" or file_ext == ".pdf":
-        return {"kind": "pdf"}
-    if (
-        mime_type and (mime_type.startswith("text/") or mime_type == "application/json")
-    ) or file_ext in TEXT_EXTENSIONS:
+    kind = None
+    if mime_type:
+        kind = _MIME_KINDS.get(mime_type) or _MIME_MAJOR_KINDS.get(
+            mime_type.partition("/")[0]
+        )
+    if kind is None:
+        kind = _EXTENSION_KINDS.get(os.path.splitext(filename)[1].lower())
+    if kind is None:
+        return {"kind": "none"}
+    if kind != "text":
+        return {"kind": kind}
+
+    snippet = ""
+    has_more = False
+    try:
+        # One binary read covers PREVIEW_CHARS characters even at four bytes
+        # each, so the file size and the decoded length tell us whether there
+        # is more without a second read. Callers pass the indexed size when
+        # they have it, which also saves the fstat.
+        with path.open("rb") as f:
+            if size is None:
+                size = os.fstat(f.fileno()).st_size
+            raw = f.read(PREVIEW_CHARS * 4)
+        text = raw.decode("utf-8", errors="replace")
+        text = text.replace("\r\n", "\n").replace("\r", "\n")
+        snippet = text[:PREVIEW_CHARS]
+        has_more = len(text) > PREVIEW_CHARS or size > len(raw)
+    except Exception:
         snippet = ""
-        has_more = False
-        try:
-            with path.open("r", encoding="utf-8", errors="replace") as f:
-                snippet = f.read(4000)
-                if f.read(1):
-                    has_more = True
-        except Exception:
-            snippet = ""
-        if snippet:
-            return {"kind": "text", "snippet": snippet, "truncated": has_more}
+    if snippet:
+        return {"kind": "text", "snippet": snippet, "truncated": has_more}
     return {"kind": "none"}
 
 
 def make_file_url(request: web.Request, token: str) -> str:
-    if EXTERNAL_URL:
-        base = EXTERNAL_URL.rstrip("/")
-        return f"{base}/files/{token}"
+    if _EXTERNAL_BASE:
+        return f"{_EXTERNAL_BASE}/files/{token}"
     scheme = request.scheme
     host = request.headers.get("Host") or f"{HTTP_HOST}:{HTTP_PORT}"
     return f"{scheme}://{host}/files/{token}"
 
 
 def public_base_url() -> str:
-    if EXTERNAL_URL:
-        return EXTERNAL_URL.rstrip("/")
-    if PUBLIC_BASE_URL:
-        return PUBLIC_BASE_URL.rstrip("/")
-    return f"http://{HTTP_HOST}:{HTTP_PORT}"
+    return _PUBLIC_BASE
 
 
 def file_page_url(token: str) -> str:
-    base = public_base_url().rstrip("/")
-    return f"{base}/files/{token}"
+    return f"{_PUBLIC_BASE}/files/{token}"
 
 
 def client_ip_from_request(request: web.Request) -> str:
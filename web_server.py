@@ -2,16 +2,20 @@ from __future__ import annotations
 
 import asyncio
 import contextlib
+import gzip
+import hashlib
 import hmac
-import json
-import mimetypes
+import html
 import os
+import pathlib
+import secrets
 import time
-import uuid
-from typing import Dict, List
-from urllib.parse import splitport, unquote, urlencode
+from functools import lru_cache
+from typing import Awaitable, Callable, Dict, List, Mapping, Tuple
+from urllib.parse import unquote, urlencode
 
-from aiohttp import web
+import orjson
+from aiohttp import BodyPartReader, web
 
 from config import (
     ASSETS_DIR,
@@ -19,7 +23,6 @@ from config import (
     HTTP_HOST,
     HTTP_LISTING_PORT,
     HTTP_LOGIN_PORT,
-    HTTP_PORT,
     LISTING_CREDENTIALS_FILE,
     LISTING_HOME_URL,
     LISTING_LOGIN_ASSETS_DIR,
@@ -31,30 +34,67 @@ from config import (
     MAX_IP_STORAGE_BYTES,
     MAX_UPLOAD_BYTES,
     PREVIEW_TEMPLATE,
+    UPLOAD_CHUNK_BYTES,
     UPLOAD_DIR,
     UPLOAD_PAGE,
 )
-from file_index import load_index, save_index
+from file_index import (
+    add_entry,
+    flush_index,
+    load_index,
+    remove_entry,
+    tokens_by_time,
+    tokens_for_ip,
+    usage_for_ip,
+)
 from helpers import (
     build_preview_payload,
     client_ip_from_request,
     escape_filename,
     file_page_url,
     format_timestamp,
+    guess_mime_type,
     human_readable_size,
     make_file_url,
     render_template,
 )
 
+Handler = Callable[[web.Request], Awaitable[web.StreamResponse]]
+Route = Tuple[str, str, Handler]
+
 SESSION_COOKIE = "listing_session"
-ALLOWED_USERS: dict[str, str] = {}
+# username -> keyed BLAKE2b digest of the password. Plaintext passwords are
+# not kept in memory, and every comparison is between equal-length digests.
+ALLOWED_USERS: dict[str, bytes] = {}
+_PASSWORD_KEY = secrets.token_bytes(32)
 AUTH_ENABLED = False
+# Credentials file (mtime_ns, size) as last applied and the monotonic time it
+# was last checked, so handlers only re-read the file after it changes.
+CREDENTIALS_RECHECK_SECONDS = 5.0
+_CREDENTIALS_STATE: dict[str, object] = {"stamp": None, "checked": 0.0, "loaded": False}
 SESSION_SECRET_BYTES = (LISTING_SESSION_SECRET or "listing-secret").encode("utf-8")
 SESSION_TTL = max(int(LISTING_SESSION_TTL), 0)
+# Read size for FileResponse when sendfile is unavailable (e.g. TLS).
+FILE_RESPONSE_CHUNK_BYTES = 1024 * 1024
+# Browser cache lifetime for the upload and download pages; short so edits
+# still show up, and revalidation after that is a 304.
+STATIC_PAGE_MAX_AGE = 300
+# Upper bound on the multipart boundaries and part headers around an uploaded
+# file, used when judging a request's Content-Length against the quota.
+MULTIPART_OVERHEAD_BYTES = 64 * 1024
+# Body limit for listing/login requests (aiohttp's default). They share an
+# application with the uploader, whose limit is MAX_UPLOAD_BYTES.
+LISTING_MAX_BODY_BYTES = 1024 * 1024
+
+
+# Keyed once; copying it skips re-deriving the HMAC pads for every cookie.
+_SESSION_HMAC = hmac.new(SESSION_SECRET_BYTES, None, "sha256")
 
 
 def _sign(payload: str) -> str:
-    return hmac.new(SESSION_SECRET_BYTES, payload.encode("utf-8"), "sha256").hexdigest()
+    mac = _SESSION_HMAC.copy()
+    mac.update(payload.encode("utf-8"))
+    return mac.hexdigest()
 
 
 def create_session_token(username: str) -> str:
@@ -64,20 +104,30 @@ def create_session_token(username: str) -> str:
     return f"{payload}|{signature}"
 
 
+@lru_cache(maxsize=4096)
+def _verify_signature(payload: str, signature: str) -> tuple[bool, int]:
+    # The secret is fixed for the lifetime of the process, so a cookie only
+    # needs its HMAC checked once; expiry is still enforced by the caller.
+    if not hmac.compare_digest(_sign(payload), signature):
+        return False, 0
+    try:
+        issued = int(payload.rpartition("|")[2])
+    except ValueError:
+        return False, 0
+    return True, issued
+
+
 def validate_session_token(token: str) -> bool:
-    parts = token.split("|")
-    if len(parts) != 3:
+    # "user|issued|signature": the signed payload is everything before the
+    # last "|", so it is sliced out rather than split and re-joined.
+    payload, _, signature = token.rpartition("|")
+    username, sep, issued_str = payload.partition("|")
+    if not sep or "|" in issued_str:
         return False
-    username, issued_str, signature = parts
     if username not in ALLOWED_USERS:
         return False
-    payload = f"{username}|{issued_str}"
-    expected = _sign(payload)
-    if not hmac.compare_digest(expected, signature):
-        return False
-    try:
-        issued = int(issued_str)
-    except ValueError:
+    valid, issued = _verify_signature(payload, signature)
+    if not valid:
         return False
     if SESSION_TTL and (time.time() - issued) > SESSION_TTL:
         return False
@@ -89,7 +139,7 @@ def load_file_credentials() -> list[tuple[str, str]]:
     if not path.exists():
         return []
     try:
-        raw = json.loads(path.read_text(encoding="utf-8"))
+        raw = orjson.loads(path.read_bytes())
     except Exception:
         return []
     records: list[tuple[str, str]] = []
@@ -109,23 +159,87 @@ def load_file_credentials() -> list[tuple[str, str]]:
     return records
 
 
-def refresh_allowed_users() -> None:
+def save_file_credentials(creds: Mapping[str, str]) -> None:
+    path = LISTING_CREDENTIALS_FILE
+    path.parent.mkdir(parents=True, exist_ok=True)
+    payload = {"users": [{"username": u, "password": p} for u, p in creds.items()]}
+    path.write_bytes(orjson.dumps(payload, option=orjson.OPT_INDENT_2))
+
+
+def upsert_file_credential(username: str, password: str) -> bool:
+    # Returns whether the user already existed. Blocking file I/O; callers on
+    # the event loop should run it in a thread.
+    current = dict(load_file_credentials())
+    existed = username in current
+    current[username] = password
+    save_file_credentials(current)
+    return existed
+
+
+def _password_digest(password: str) -> bytes:
+    return hashlib.blake2b(password.encode("utf-8"), key=_PASSWORD_KEY).digest()
+
+
+def _apply_allowed_users(file_creds: list[tuple[str, str]]) -> None:
     global AUTH_ENABLED
     env_user = os.getenv("LISTING_USERNAME")
     env_pass = os.getenv("LISTING_PASSWORD")
-    combined: dict[str, str] = {}
+    combined: dict[str, bytes] = {}
     if env_user and env_pass:
-        combined[env_user] = env_pass
-    for user, pwd in load_file_credentials():
-        combined[user] = pwd
+        combined[env_user] = _password_digest(env_pass)
+    for user, pwd in file_creds:
+        combined[user] = _password_digest(pwd)
     ALLOWED_USERS.clear()
     ALLOWED_USERS.update(combined)
     AUTH_ENABLED = bool(ALLOWED_USERS)
 
 
+def _credentials_stamp() -> tuple[int, int] | None:
+    try:
+        stat = LISTING_CREDENTIALS_FILE.stat()
+    except OSError:
+        return None
+    return stat.st_mtime_ns, stat.st_size
+
+
+def refresh_allowed_users() -> None:
+    # Always re-stats, so callers that just wrote the file see it at once;
+    # the file is only re-read when its stamp changed.
+    stamp = _credentials_stamp()
+    _CREDENTIALS_STATE["checked"] = time.monotonic()
+    if _CREDENTIALS_STATE["loaded"] and stamp == _CREDENTIALS_STATE["stamp"]:
+        return
+    _apply_allowed_users(load_file_credentials())
+    _CREDENTIALS_STATE.update(stamp=stamp, loaded=True)
+
+
+async def refresh_allowed_users_async(force: bool = False) -> None:
+    # Request handlers check the file at most every CREDENTIALS_RECHECK_SECONDS
+    # and read it in a worker thread; the shared table is swapped on the loop.
+    # force skips the throttle, for callers that just wrote the file.
+    now = time.monotonic()
+    if (
+        not force
+        and _CREDENTIALS_STATE["loaded"]
+        and now - _CREDENTIALS_STATE["checked"] < CREDENTIALS_RECHECK_SECONDS
+    ):
+        return
+    _CREDENTIALS_STATE["checked"] = now
+    stamp = _credentials_stamp()
+    if _CREDENTIALS_STATE["loaded"] and stamp == _CREDENTIALS_STATE["stamp"]:
+        return
+    _apply_allowed_users(await asyncio.to_thread(load_file_credentials))
+    _CREDENTIALS_STATE.update(stamp=stamp, loaded=True)
+
+
 def verify_credentials(username: str, password: str) -> bool:
+    supplied = _password_digest(password)
     expected = ALLOWED_USERS.get(username)
-    return expected is not None and expected == password
+    if expected is None:
+        # Burn a comparison anyway so unknown users take as long as bad passwords.
+        hmac.compare_digest(supplied, supplied)
+        return False
+    return hmac.compare_digest(expected, supplied)
 
 
 def is_authenticated(request: web.Request) -> bool:
@@ -140,41 +254,61 @@ def is_authenticated(request: web.Request) -> bool:
 def sanitize_next(target: str | None) -> str:
     if not target:
         return "/"
-    try:
-        candidate = unquote(target)
-    except Exception:
-        candidate = target
-    if not candidate.startswith("/"):
-        return "/"
-    if candidate.startswith("//"):
+    candidate = target
+    if "%" in target:
+        try:
+            candidate = unquote(target)
+        except Exception:
+            pass
+    # Only local absolute paths; "//host" would be a protocol-relative URL.
+    if candidate[0] != "/" or candidate[1:2] == "/":
         return "/"
     return candidate
 
 
+def _forwarded(request: web.Request) -> dict[str, object]:
+    # Proxy headers are read once per request; redirects and origins built
+    # afterwards reuse the parsed values stored on the request.
+    info = request.get("forwarded")
+    if info is None:
+        headers = request.headers
+        port = headers.get("X-Forwarded-Port")
+        info = {
+            "host": headers.get("X-Forwarded-Host") or headers.get("Host"),
+            "proto": headers.get("X-Forwarded-Proto") or request.scheme,
+            "port": int(port) if port and port.isdigit() else None,
+        }
+        request["forwarded"] = info
+    return info
+
+
 def _forwarded_host(request: web.Request) -> str | None:
-    return request.headers.get("X-Forwarded-Host") or request.headers.get("Host")
+    return _forwarded(request)["host"]  # type: ignore[return-value]
 
 
 def _forwarded_proto(request: web.Request) -> str:
-    return request.headers.get("X-Forwarded-Proto") or request.scheme
+    return _forwarded(request)["proto"]  # type: ignore[return-value]
 
 
 def _forwarded_port(request: web.Request) -> int | None:
-    port = request.headers.get("X-Forwarded-Port")
-    if port and port.isdigit():
-        return int(port)
-    return None
+    return _forwarded(request)["port"]  # type: ignore[return-value]
 
 
 def _is_secure(request: web.Request) -> bool:
-    proto = request.headers.get("X-Forwarded-Proto")
-    if proto:
-        return proto == "https"
-    return request.secure
+    # The cached proto falls back to request.scheme, as request.secure does.
+    return _forwarded_proto(request) == "https"
+
+
+def _split_port(host: str) -> tuple[str, str | None]:
+    # Same results as the deprecated urllib.parse.splitport, without its regex.
+    head, sep, port = host.rpartition(":")
+    if sep and (not port or (port.isascii() and port.isdigit())):
+        return head, port or None
+    return host, None
 
 
 def _split_host(host: str | None) -> tuple[str, int | None]:
-    hostname, port = splitport(host) if host else (None, None)
+    hostname, port = _split_port(host) if host else (None, None)
     if not hostname:
         hostname = HTTP_HOST
     port_value = None
@@ -185,12 +319,16 @@ def _split_host(host: str | None) -> tuple[str, int | None]:
 
 
 def _request_host(request: web.Request) -> tuple[str, int | None]:
-    forwarded = _forwarded_host(request)
-    hostname, port = _split_host(forwarded)
+    info = _forwarded(request)
+    cached = info.get("request_host")
+    if cached is not None:
+        return cached  # type: ignore[return-value]
+    hostname, port = _split_host(info["host"])  # type: ignore[arg-type]
     if not hostname:
         hostname = request.url.host or HTTP_HOST
     if port is None:
-        port = _forwarded_port(request) or request.url.port
+        port = info["port"] or request.url.port
+    info["request_host"] = (hostname, port)
     return hostname, port
 
 
@@ -239,18 +377,26 @@ def build_listing_url(request: web.Request, next_path: str = "/") -> str:
 
 
 def is_login_port_request(request: web.Request) -> bool:
+    info = _forwarded(request)
+    cached = info.get("login_port")
+    if cached is None:
+        cached = info["login_port"] = _request_port(request) == HTTP_LOGIN_PORT
+    return cached  # type: ignore[return-value]
+
+
+def _request_port(request: web.Request) -> int:
     port = _forwarded_port(request)
     if port is None:
         host_header = request.headers.get("Host")
         if host_header:
-            _, host_port = splitport(host_header)
+            _, host_port = _split_port(host_header)
             if host_port and host_port.isdigit():
                 port = int(host_port)
     if port is None:
         port = request.url.port
     if port is None:
         port = 443 if _forwarded_proto(request) == "https" else 80
-    return port == HTTP_LOGIN_PORT
+    return port
 
 
 def login_redirect_response(
@@ -259,73 +405,236 @@ def login_redirect_response(
     return web.HTTPFound(location=build_login_url(request, next_path, error))
 
 
-@web.middleware
-async def error_middleware(request: web.Request, handler):
+def _write_all(fd: int, data: bytearray) -> None:
+    view = memoryview(data)
+    while view:
+        view = view[os.write(fd, view) :]
+
+
+def _close_upload(fd: int, complete: bool) -> None:
+    # The finished upload is rarely read back right away; let the kernel drop
+    # its pages instead of evicting hotter data. Dirty pages are not dropped,
+    # so a kept upload is synced first (which also makes it durable before it
+    # is indexed); a discarded one is about to be unlinked anyway.
     try:
-        return await handler(request)
-    except web.HTTPRequestEntityTooLarge as exc:
-        limit = human_readable_size(exc.max_size or MAX_UPLOAD_BYTES)
-        return web.json_response(
-            {"error": f"ファイルサイズが大きすぎます。上限: {limit}"},
-            status=exc.status,
-        )
-    except web.HTTPException:
-        raise
-    except Exception as exc:
-        return web.json_response({"error": str(exc)}, status=500)
+        if complete and hasattr(os, "fdatasync"):
+            os.fdatasync(fd)
+        if hasattr(os, "posix_fadvise"):
+            with contextlib.suppress(OSError):
+                os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+    finally:
+        os.close(fd)
+
+
+async def _drain(
+    field: BodyPartReader, dest: pathlib.Path, limit: int
+) -> tuple[int, bool]:
+    # Returns (bytes written, limit exceeded). A limit of 0 disables the check;
+    # once it trips the rest of the field is left unread.
+    size = 0
+    complete = False
+    buffer = bytearray()
+    flags = os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, "O_BINARY", 0)
+    fd = await asyncio.to_thread(os.open, dest, flags, 0o666)
+    try:
+        while True:
+            chunk = await field.read_chunk(size=UPLOAD_CHUNK_BYTES)
+            size += len(chunk)
+            if limit > 0 and size > limit:
+                return size, True
+            buffer += chunk
+            # read_chunk() often returns far less than asked for; collect
+            # reads so the worker thread gets one write per UPLOAD_CHUNK_BYTES.
+            if len(buffer) >= UPLOAD_CHUNK_BYTES or (buffer and not chunk):
+                await asyncio.to_thread(_write_all, fd, buffer)
+                buffer.clear()
+            if not chunk:
+                complete = True
+                return size, False
+    finally:
+        await asyncio.to_thread(_close_upload, fd, complete)
 
 
-def create_uploader_app() -> web.Application:
-    app = web.Application(
-        middlewares=[error_middleware], client_max_size=MAX_UPLOAD_BYTES
+def _json_response(data: object, status: int = 200) -> web.Response:
+    return _json_body_response(orjson.dumps(data), status)
+
+
+def _json_body_response(body: bytes, status: int = 200) -> web.Response:
+    return web.Response(body=body, status=status, content_type="application/json")
+
+
+def _load_pages(*paths: pathlib.Path) -> dict[pathlib.Path, bytes]:
+    return {path: path.read_bytes() for path in paths if path.exists()}
+
+
+def _html_response(body: bytes, status: int = 200) -> web.Response:
+    return web.Response(
+        body=body, status=status, content_type="text/html", charset="utf-8"
+    )
+
+
+# A static page as (body, ETag) pairs keyed by whether the client takes gzip.
+StaticPage = Dict[bool, Tuple[bytes, str]]
+
+
+def _static_page(body: bytes) -> StaticPage:
+    # Compressed once at startup; each encoding gets its own strong ETag.
+    digest = hashlib.blake2b(body, digest_size=16).hexdigest()
+    return {
+        False: (body, f'"{digest}"'),
+        True: (gzip.compress(body, 9), f'"{digest}-gz"'),
+    }
+
+
+@lru_cache(maxsize=256)
+def _accepts_gzip(accept_encoding: str) -> bool:
+    # Browsers send only a handful of distinct headers, so each is parsed
+    # once. An explicit gzip (or x-gzip) entry wins over "*"; q=0 refuses.
+    wildcard = False
+    for item in accept_encoding.split(","):
+        coding, *params = item.split(";")
+        coding = coding.strip().lower()
+        q = 1.0
+        for param in params:
+            name, _, value = param.partition("=")
+            if name.strip().lower() == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        if coding in ("gzip", "x-gzip"):
+            return q > 0
+        if coding == "*":
+            wildcard = q > 0
+    return wildcard
+
+
+def _static_html_response(
+    request: web.Request, page: StaticPage, max_age: int
+) -> web.Response:
+    gzipped = _accepts_gzip(request.headers.get("Accept-Encoding", ""))
+    body, etag = page[gzipped]
+    # Vary goes on every variant, 304s included, so shared caches keep the
+    # two encodings apart.
+    headers = {
+        "Cache-Control": f"public, max-age={max_age}",
+        "ETag": etag,
+        "Vary": "Accept-Encoding",
+    }
+    if any(tag.value in (etag[1:-1], "*") for tag in request.if_none_match or ()):
+        return web.Response(status=304, headers=headers)
+    if gzipped:
+        headers["Content-Encoding"] = "gzip"
+    return web.Response(
+        body=body, content_type="text/html", charset="utf-8", headers=headers
+    )
+
+
+def _is_listing_listener(request: web.Request) -> bool:
+    sockname = (
+        request.transport.get_extra_info("sockname") if request.transport else None
+    )
+    port = sockname[1] if isinstance(sockname, tuple) else None
+    return port in (HTTP_LISTING_PORT, HTTP_LOGIN_PORT)
+
+
+def _dispatch_by_listener(
+    upload_handler: Handler | None, listing_handler: Handler | None
+) -> Handler:
+    async def handler(request: web.Request) -> web.StreamResponse:
+        chosen = listing_handler if _is_listing_listener(request) else upload_handler
+        if chosen is None:
+            raise web.HTTPNotFound()
+        return await chosen(request)
+
+    return handler
+
+
+def _uploader_routes() -> list[Route]:
+    # The upload and download pages are public and identical for every
+    # visitor, so they are served compressed with validators.
+    static_pages = {
+        path: _static_page(body)
+        for path, body in _load_pages(UPLOAD_PAGE, DOWNLOAD_PAGE).items()
+    }
+
+    # The 404 page has no per-request values, so like the static pages it is
+    # rendered once when the routes are built.
+    not_found_page = (
+        render_template(
+            LISTING_NOT_FOUND_PAGE, {"LISTING_URL": LISTING_HOME_URL}
+        ).encode("utf-8")
+        if LISTING_NOT_FOUND_PAGE.exists()
+        else None
     )
+    has_preview_template = PREVIEW_TEMPLATE.exists()
 
     def file_not_found_page() -> web.Response:
-        if LISTING_NOT_FOUND_PAGE.exists():
-            rendered = render_template(
-                LISTING_NOT_FOUND_PAGE,
-                {"LISTING_URL": LISTING_HOME_URL},
-            )
-            return web.Response(
-                text=rendered,
-                content_type="text/html",
-                charset="utf-8",
-                status=404,
-            )
+        if not_found_page is not None:
+            return _html_response(not_found_page, status=404)
         return web.Response(text="file not found", status=404)
 
+    # Link-preview crawlers fetch the same few files repeatedly. The base URL
+    # is part of the key because it follows the request's Host header.
+    @lru_cache(maxsize=2048)
+    def preview_page(token: str, title: str, size_bytes: int, base_url: str) -> bytes:
+        # base_url comes from the Host header, so it is escaped like the title.
+        url = html.escape(base_url)
+        replacements = {
+            "TITLE": title,
+            "DESCRIPTION": f"ファイルサイズ: {human_readable_size(size_bytes)}",
+            "URL": url,
+            "IMAGE_URL": f"{url}?raw=inline",
+            "TOKEN": token,
+        }
+        return render_template(PREVIEW_TEMPLATE, replacements).encode("utf-8")
+
     async def handle_root(request: web.Request):
-        if UPLOAD_PAGE.exists():
-            return web.FileResponse(
-                UPLOAD_PAGE, headers={"Content-Type": "text/html; charset=utf-8"}
+        if UPLOAD_PAGE in static_pages:
+            return _static_html_response(
+                request, static_pages[UPLOAD_PAGE], STATIC_PAGE_MAX_AGE
             )
         return web.Response(text="upload.html not found", status=404)
 
     async def handle_upload(request: web.Request):
-        reader = await request.multipart()
-        field = await reader.next()
-        if field is None or field.name != "file":
-            return web.json_response({"error": "missing file field"}, status=400)
+        # Only uploads translate errors into JSON for the upload page's
+        # script, so the other routes run without a wrapping middleware.
+        try:
+            return await store_upload(request)
+        except web.HTTPRequestEntityTooLarge as exc:
+            # The exception keeps no max_size attribute; the limit is ours.
+            limit = human_readable_size(MAX_UPLOAD_BYTES)
+            return _json_response(
+                {"error": f"ファイルサイズが大きすぎます。上限: {limit}"},
+                status=exc.status,
+            )
+        except web.HTTPException:
+            raise
+        except Exception as exc:
+            return _json_response({"error": str(exc)}, status=500)
 
-        filename = field.filename
-        token = uuid.uuid4().hex
-        saved_name = f"{token}-{filename}"
-        dest = UPLOAD_DIR / saved_name
+    def quota_exceeded(quota_limit: int, current_usage: int) -> web.Response:
+        remaining = max(quota_limit - current_usage, 0)
+        return _json_response(
+            {
+                "error": "同じIPからアップロードできる容量の上限を超えました。",
+                "limit": human_readable_size(quota_limit),
+                "used": human_readable_size(current_usage),
+                "remaining": human_readable_size(remaining),
+            },
+            status=400,
+        )
 
-        index = load_index()
+    async def store_upload(request: web.Request) -> web.Response:
         client_ip = client_ip_from_request(request)
         quota_limit = MAX_IP_STORAGE_BYTES
         current_usage = 0
         if quota_limit > 0:
-            current_usage = sum(
-                meta.get("size", 0)
-                for meta in index.values()
-                if meta.get("ip") == client_ip
-            )
+            current_usage = usage_for_ip(client_ip)
             if current_usage >= quota_limit:
                 limit_str = human_readable_size(quota_limit)
                 used_str = human_readable_size(current_usage)
-                return web.json_response(
+                return _json_response(
                     {
                         "error": "同じIPからアップロードできる容量の上限を超えています。",
                         "limit": limit_str,
@@ -334,22 +643,51 @@ def create_uploader_app() -> web.Application:
                     },
                     status=400,
                 )
+            # The body is the file plus a little multipart framing, so a
+            # declared length beyond remaining quota plus that allowance can
+            # be refused before a single byte is read.
+            declared = request.content_length
+            if (
+                declared is not None
+                and declared - MULTIPART_OVERHEAD_BYTES > quota_limit - current_usage
+            ):
+                return quota_exceeded(quota_limit, current_usage)
+
+        reader = await request.multipart()
+        field = await reader.next()
+        if field is None or field.name != "file":
+            return _json_response({"error": "missing file field"}, status=400)
+        # Browsers rarely send it, but a part that declares its own length can
+        # be refused before the destination file is created.
+        part_length = field.headers.get("Content-Length", "")
+        if part_length.isdigit():
+            if int(part_length) > MAX_UPLOAD_BYTES:
+                raise web.HTTPRequestEntityTooLarge(
+                    max_size=MAX_UPLOAD_BYTES, actual_size=int(part_length)
+                )
+            if quota_limit > 0 and int(part_length) > quota_limit - current_usage:
+                return quota_exceeded(quota_limit, current_usage)
+
+        # Everything derived from the name is settled before the file is
+        # written, so a bad name cannot strand a stored upload.
+        filename = field.filename or "file"
+        escaped_filename = escape_filename(filename)
+        mime_type = guess_mime_type(filename)
+        token = secrets.token_hex(16)
+        saved_name = f"{token}-{filename}"
+        dest = UPLOAD_DIR / saved_name
 
+        # Multipart bodies are streamed past aiohttp's client_max_size, so the
+        # upload size cap is enforced here along with the remaining quota.
+        limit = MAX_UPLOAD_BYTES
+        if quota_limit > 0:
+            limit = min(limit, quota_limit - current_usage)
         size = 0
-        quota_hit = False
+        over_limit = False
         upload_completed = False
         try:
-            with dest.open("wb") as f:
-                while True:
-                    chunk = await field.read_chunk()
-                    if not chunk:
-                        upload_completed = True
-                        break
-                    f.write(chunk)
-                    size += len(chunk)
-                    if quota_limit > 0 and (current_usage + size) > quota_limit:
-                        quota_hit = True
-                        break
+            size, over_limit = await _drain(field, dest, limit)
+            upload_completed = not over_limit
         except asyncio.CancelledError:
             dest.unlink(missing_ok=True)
             raise
@@ -361,33 +699,35 @@ def create_uploader_app() -> web.Application:
                 with contextlib.suppress(Exception):
                     await field.release()
 
-        if quota_hit:
-            dest.unlink(missing_ok=True)
-            limit_str = human_readable_size(quota_limit)
-            used_str = human_readable_size(current_usage)
-            remaining = max(quota_limit - current_usage, 0)
-            return web.json_response(
-                {
-                    "error": "同じIPからアップロードできる容量の上限を超えました。",
-                    "limit": limit_str,
-                    "used": used_str,
-                    "remaining": human_readable_size(remaining),
-                },
-                status=400,
-            )
+        if over_limit:
+            await asyncio.to_thread(dest.unlink, missing_ok=True)
+            if size > MAX_UPLOAD_BYTES:
+                raise web.HTTPRequestEntityTooLarge(
+                    max_size=MAX_UPLOAD_BYTES, actual_size=size
+                )
+            return quota_exceeded(quota_limit, current_usage)
 
-        index[token] = {
-            "filename": filename,
-            "saved_name": saved_name,
-            "size": size,
-            "timestamp": int(time.time()),
-            "ip": client_ip,
-            "uploader": "web",
-        }
-        save_index(index)
+        try:
+            timestamp = int(time.time())
+            meta = {
+                "filename": filename,
+                "escaped_filename": escaped_filename,
+                "saved_name": saved_name,
+                "size": size,
+                "size_readable": human_readable_size(size),
+                "timestamp": timestamp,
+                "uploaded_at": format_timestamp(timestamp),
+                "mime_type": mime_type,
+                "ip": client_ip,
+                "uploader": "web",
+            }
+            add_entry(token, meta)
+        except Exception:
+            dest.unlink(missing_ok=True)
+            raise
 
         url = make_file_url(request, token)
-        return web.json_response({"url": url, "token": token})
+        return _json_response({"url": url, "token": token})
 
     async def handle_get_file(request: web.Request):
         token = request.match_info.get("token")
@@ -401,34 +741,34 @@ def create_uploader_app() -> web.Application:
 
         filename = meta.get("filename", "file")
         size_bytes = meta.get("size", 0)
-        base_url = make_file_url(request, token).split("?")[0]
-        inline_url = f"{base_url}?raw=inline"
+        base_url = make_file_url(request, token).partition("?")[0]
 
         raw_mode = request.query.get("raw")
         if raw_mode is not None:
-            headers = {}
+            # Uploads never change under a token, so clients may keep them;
+            # FileResponse supplies ETag/Last-Modified and answers 304s itself.
+            headers = {"Cache-Control": "public, max-age=31536000, immutable"}
             if raw_mode != "inline":
                 headers["Content-Disposition"] = f'attachment; filename="{filename}"'
-            return web.FileResponse(path, headers=headers)
+            return web.FileResponse(
+                path, chunk_size=FILE_RESPONSE_CHUNK_BYTES, headers=headers
+            )
 
         if request.query.get("preview") == "1":
-            if not PREVIEW_TEMPLATE.exists():
+            if not has_preview_template:
                 return web.Response(text="preview template missing", status=500)
-            replacements = {
-                "TITLE": escape_filename(filename),
-                "DESCRIPTION": f"ファイルサイズ: {human_readable_size(size_bytes)}",
-                "URL": base_url,
-                "IMAGE_URL": inline_url,
-                "TOKEN": token,
-            }
-            rendered = render_template(PREVIEW_TEMPLATE, replacements)
-            return web.Response(
-                text=rendered, content_type="text/html", charset="utf-8"
+            return _html_response(
+                preview_page(
+                    token,
+                    meta.get("escaped_filename") or escape_filename(filename),
+                    size_bytes,
+                    base_url,
+                )
             )
 
-        if DOWNLOAD_PAGE.exists():
-            return web.FileResponse(
-                DOWNLOAD_PAGE, headers={"Content-Type": "text/html; charset=utf-8"}
+        if DOWNLOAD_PAGE in static_pages:
+            return _static_html_response(
+                request, static_pages[DOWNLOAD_PAGE], STATIC_PAGE_MAX_AGE
             )
         return web.Response(text="download page not found", status=404)
 
@@ -437,27 +777,31 @@ def create_uploader_app() -> web.Application:
         index = load_index()
         meta = index.get(token)
         if not meta:
-            return web.json_response({"error": "not found"}, status=404)
+            return _json_response({"error": "not found"}, status=404)
         path = UPLOAD_DIR / meta["saved_name"]
         if not path.exists():
-            return web.json_response({"error": "file missing"}, status=404)
+            return _json_response({"error": "file missing"}, status=404)
 
         filename = meta.get("filename", "file")
         size_bytes = meta.get("size", 0)
-        base_url = make_file_url(request, token).split("?")[0]
+        base_url = make_file_url(request, token).partition("?")[0]
         download_url = f"{base_url}?raw=1"
         inline_url = f"{base_url}?raw=inline"
-        mime_type, _ = mimetypes.guess_type(filename)
-        preview = build_preview_payload(path, filename, mime_type)
+        mime_type = meta.get("mime_type") or guess_mime_type(filename)
+        preview = await asyncio.to_thread(
+            build_preview_payload, path, filename, mime_type, meta.get("size")
+        )
 
-        return web.json_response(
+        return _json_response(
             {
                 "token": token,
                 "filename": filename,
                 "size": size_bytes,
-                "size_readable": human_readable_size(size_bytes),
+                "size_readable": meta.get("size_readable")
+                or human_readable_size(size_bytes),
                 "timestamp": meta.get("timestamp"),
-                "uploaded_at": format_timestamp(meta.get("timestamp")),
+                "uploaded_at": meta.get("uploaded_at")
+                or format_timestamp(meta.get("timestamp")),
                 "mime_type": mime_type,
                 "download_url": download_url,
                 "inline_url": inline_url,
@@ -469,19 +813,21 @@ def create_uploader_app() -> web.Application:
     async def handle_list(request: web.Request):
         index = load_index()
         client_ip = client_ip_from_request(request)
-        items = []
-        for token, meta in index.items():
-            if meta.get("ip") == client_ip:
-                items.append(
-                    {
-                        "token": token,
-                        "filename": meta.get("filename"),
-                        "size": meta.get("size"),
-                        "timestamp": meta.get("timestamp"),
-                        "url": make_file_url(request, token),
-                    }
-                )
-        return web.json_response(items)
+        # Every row shares the same origin, so the URL prefix is built once.
+        url_prefix = make_file_url(request, "")
+        return _json_response(
+            [
+                {
+                    "token": token,
+                    "filename": meta.get("filename"),
+                    "size": meta.get("size"),
+                    "timestamp": meta.get("timestamp"),
+                    "url": url_prefix + token,
+                }
+                for token in tokens_for_ip(client_ip)
+                if (meta := index.get(token))
+            ]
+        )
 
     async def handle_delete(request: web.Request):
         token = request.match_info.get("token")
@@ -491,42 +837,35 @@ def create_uploader_app() -> web.Application:
             raise web.HTTPNotFound(text="file not found")
         client_ip = client_ip_from_request(request)
         if meta.get("ip") != client_ip:
-            return web.json_response({"error": "not allowed"}, status=403)
+            return _json_response({"error": "not allowed"}, status=403)
         path = UPLOAD_DIR / meta["saved_name"]
-        if path.exists():
-            path.unlink()
-        del index[token]
-        save_index(index)
-        return web.json_response({"ok": True})
-
-    app.router.add_get("/", handle_root)
-    app.router.add_post("/api/upload", handle_upload)
-    app.router.add_get("/files/{token}", handle_get_file)
-    app.router.add_get("/api/files", handle_list)
-    app.router.add_get("/api/file/{token}", handle_file_info)
-    app.router.add_delete("/api/delete/{token}", handle_delete)
-
-    if ASSETS_DIR.exists():
-        app.router.add_static("/assets", str(ASSETS_DIR))
-
-    return app
-
-
-def create_listing_app() -> web.Application:
-    app = web.Application(middlewares=[error_middleware])
-
-    def serve_login_page() -> web.StreamResponse:
-        if LISTING_LOGIN_PAGE.exists():
-            return web.FileResponse(
-                LISTING_LOGIN_PAGE,
-                headers={"Content-Type": "text/html; charset=utf-8"},
-            )
+        await asyncio.to_thread(path.unlink, missing_ok=True)
+        remove_entry(token)
+        return _json_response({"ok": True})
+
+    return [
+        ("GET", "/", handle_root),
+        ("POST", "/api/upload", handle_upload),
+        ("GET", "/files/{token}", handle_get_file),
+        ("GET", "/api/files", handle_list),
+        ("GET", "/api/file/{token}", handle_file_info),
+        ("DELETE", "/api/delete/{token}", handle_delete),
+    ]
+
+
+def _listing_routes() -> list[Route]:
+    pages = _load_pages(LISTING_PAGE, LISTING_LOGIN_PAGE)
+
+    def serve_login_page() -> web.Response:
+        if LISTING_LOGIN_PAGE in pages:
+            return _html_response(pages[LISTING_LOGIN_PAGE])
         return web.Response(text="login page not found", status=500)
 
     refresh_allowed_users()
+    listing_cache: Dict[str, object] = {"order": None, "body": b""}
 
     async def handle_root(request: web.Request):
-        refresh_allowed_users()
+        await refresh_allowed_users_async()
         if is_login_port_request(request):
             return serve_login_page()
 
@@ -534,23 +873,21 @@ def create_listing_app() -> web.Application:
             next_path = sanitize_next(request.rel_url.path_qs or "/")
             raise login_redirect_response(request, next_path)
 
-        if LISTING_PAGE.exists():
-            return web.FileResponse(
-                LISTING_PAGE, headers={"Content-Type": "text/html; charset=utf-8"}
-            )
+        if LISTING_PAGE in pages:
+            return _html_response(pages[LISTING_PAGE])
         return web.Response(text="listing page not found", status=404)
 
     async def handle_login_page(request: web.Request):
         if is_login_port_request(request):
             return serve_login_page()
-        refresh_allowed_users()
+        await refresh_allowed_users_async()
         next_path = sanitize_next(request.rel_url.query.get("next"))
         raise login_redirect_response(request, next_path)
 
     async def handle_login_submit(request: web.Request):
         if not AUTH_ENABLED:
             return serve_login_page()
-        refresh_allowed_users()
+        await refresh_allowed_users_async()
         form = await request.post()
         username = form.get("username", "")
         password = form.get("password", "")
@@ -576,40 +913,104 @@ def create_listing_app() -> web.Application:
 
     async def handle_listing(request: web.Request):
         if AUTH_ENABLED and not is_authenticated(request):
-            return web.json_response({"error": "unauthorized"}, status=401)
+            return _json_response({"error": "unauthorized"}, status=401)
         index = load_index()
+        order = tokens_by_time()
+        # tokens_by_time() hands out a new list after every change, so the
+        # encoded body is reused until an upload, delete or reload.
+        if listing_cache["order"] is order:
+            return _json_body_response(listing_cache["body"])
         records: List[Dict[str, object]] = []
-        for token, meta in index.items():
-            timestamp = meta.get("timestamp") or 0
+        for token in order:
+            meta = index[token]
             filename = meta.get("filename", "file")
-            mime_type, _ = mimetypes.guess_type(filename)
+            mime_type = meta.get("mime_type") or guess_mime_type(filename)
             file_type = mime_type or "不明"
             records.append(
                 {
                     "filename": filename,
                     "size": meta.get("size", 0),
-                    "size_readable": human_readable_size(meta.get("size", 0)),
-                    "uploaded_at": format_timestamp(timestamp),
+                    "size_readable": meta.get("size_readable")
+                    or human_readable_size(meta.get("size", 0)),
+                    "uploaded_at": meta.get("uploaded_at")
+                    or format_timestamp(meta.get("timestamp") or 0),
                     "file_type": file_type,
                     "url": file_page_url(token),
-                    "timestamp": timestamp,
                     "token": token,
                 }
             )
+        body = orjson.dumps(records)
+        listing_cache.update(order=order, body=body)
+        return _json_body_response(body)
+
+    routes = [
+        ("GET", "/", handle_root),
+        ("GET", "/login", handle_login_page),
+        ("POST", "/login", handle_login_submit),
+        ("GET", "/logout", handle_logout),
+        ("POST", "/logout", handle_logout),
+        ("GET", "/api/files", handle_listing),
+    ]
 
-        records.sort(key=lambda item: item["timestamp"], reverse=True)
-        for record in records:
-            record.pop("timestamp", None)
-        return web.json_response(records)
-
-    app.router.add_get("/", handle_root)
-    app.router.add_get("/login", handle_login_page)
-    app.router.add_post("/login", handle_login_submit)
-    app.router.add_get("/logout", handle_logout)
-    app.router.add_post("/logout", handle_logout)
-    app.router.add_get("/api/files", handle_listing)
     if LISTING_LOGIN_ASSETS_DIR.exists():
-        app.router.add_static("/login/assets", str(LISTING_LOGIN_ASSETS_DIR))
+        # Served as a route rather than with add_static so that, like the
+        # other listing routes, it only answers on the listing/login ports.
+        assets_root = LISTING_LOGIN_ASSETS_DIR.resolve()
+
+        async def handle_login_asset(request: web.Request):
+            path = (assets_root / request.match_info["filename"]).resolve()
+            if not path.is_relative_to(assets_root) or not path.is_file():
+                raise web.HTTPNotFound()
+            return web.FileResponse(path, chunk_size=FILE_RESPONSE_CHUNK_BYTES)
+
+        routes.append(("GET", "/login/assets/{filename:.+}", handle_login_asset))
+
+    return routes
+
+
+async def _flush_index_on_cleanup(app: web.Application) -> None:
+    await flush_index()
+
+
+def _limit_body(handler: Handler, limit: int) -> Handler:
+    async def limited(request: web.Request) -> web.StreamResponse:
+        return await handler(request.clone(client_max_size=limit))
+
+    return limited
+
+
+def create_app(uploader: bool = True, listing: bool = True) -> web.Application:
+    # One application serves every listener. When both halves are enabled,
+    # each route is dispatched by the local port the request arrived on, so
+    # the upload port and the listing/login ports expose the same routes as
+    # when they were separate apps.
+    app = web.Application(client_max_size=MAX_UPLOAD_BYTES)
+    upload_routes = {(m, p): h for m, p, h in _uploader_routes()} if uploader else {}
+    listing_routes = {
+        (m, p): h if m == "GET" else _limit_body(h, LISTING_MAX_BODY_BYTES)
+        for m, p, h in (_listing_routes() if listing else ())
+    }
+    for method, path in {**upload_routes, **listing_routes}:
+        upload_handler = upload_routes.get((method, path))
+        listing_handler = listing_routes.get((method, path))
+        if uploader and listing:
+            handler = _dispatch_by_listener(upload_handler, listing_handler)
+        else:
+            handler = upload_handler or listing_handler
+        if method == "GET":
+            app.router.add_get(path, handler)
+        else:
+            app.router.add_route(method, path, handler)
+
     if ASSETS_DIR.exists():
         app.router.add_static("/assets", str(ASSETS_DIR))
+    app.on_cleanup.append(_flush_index_on_cleanup)
     return app
+
+
+def create_uploader_app() -> web.Application:
+    return create_app(listing=False)
+
+
+def create_listing_app() -> web.Application:
+    return create_app(uploader=False)